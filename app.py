@@ -1,37 +1,114 @@
 from __future__ import annotations
 
-import json
 import os
-import uuid
-from datetime import datetime
+
+# Opt-in only: `gunicorn -k gevent` monkey-patches the worker before this
+# module loads, and other entry points (dev server, sync/threaded workers)
+# must not get a patched stdlib just because gevent is installed. Set
+# USE_GEVENT=1 for entry points that cannot pass -k themselves; it must run
+# before anything imports socket/ssl.
+if os.environ.get("USE_GEVENT"):
+    from gevent import monkey
+
+    monkey.patch_all()
+
+import hashlib
+import hmac
+import json
+import mimetypes
+import tempfile
+import threading
+import time
+from secrets import token_hex
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
-from typing import Any
+from typing import Any, Final, Iterable
 
 import cloudinary
 import cloudinary.api
+import cloudinary.api_client.call_api
 import cloudinary.uploader
 import cloudinary.utils
-from flask import Flask, redirect, render_template, request, send_from_directory, url_for
+from flask import Flask, Response, make_response, redirect, render_template, request, send_from_directory, url_for
+from jinja2 import FileSystemBytecodeCache
 from werkzeug.utils import secure_filename
 
-BASE_DIR = Path(__file__).resolve().parent
-DATA_DIR = Path(os.environ.get("DATA_DIR", str(BASE_DIR)))
-UPLOAD_DIR = DATA_DIR / "uploads"
-DATA_FILE = DATA_DIR / "data.json"
-
-ALLOWED_EXTS = {".jpg", ".jpeg", ".png", ".gif", ".webp"}
-MAX_CONTENT_LENGTH = 10 * 1024 * 1024  # 10MB
-CLOUD_FOLDER = "limgp_moments"
-TAG = "limgp_moments"
-USE_CLOUDINARY = bool(os.environ.get("CLOUDINARY_URL"))
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Configuration is resolved exactly once at import; request handlers only ever
+# touch these module constants, never os.environ.
+BASE_DIR: Final[Path] = Path(__file__).resolve().parent
+DATA_DIR: Final[Path] = Path(os.environ.get("DATA_DIR", str(BASE_DIR)))
+UPLOAD_DIR: Final[Path] = DATA_DIR / "uploads"
+DATA_FILE: Final[Path] = DATA_DIR / "data.json"  # legacy store, migrated to the log on first read
+LOG_FILE: Final[Path] = DATA_DIR / "data.jsonl"
+TOMB_FILE: Final[Path] = DATA_DIR / "tombstones.txt"
+COMPACT_AFTER: Final[int] = 64  # rewrite the log once this many tombstones pile up
+
+ALLOWED_EXTS: Final[frozenset[str]] = frozenset({".jpg", ".jpeg", ".png", ".gif", ".webp"})
+MAX_CONTENT_LENGTH: Final[int] = 10 * 1024 * 1024  # 10MB
+CLOUD_FOLDER: Final[str] = "limgp_moments"
+TAG: Final[str] = "limgp_moments"
+UPLOAD_CHUNK_SIZE: Final[int] = 6 * 1024 * 1024
+USE_CLOUDINARY: Final[bool] = bool(os.environ.get("CLOUDINARY_URL"))
+REQUIRED_TOKEN: Final[str] = os.environ.get("UPLOAD_TOKEN", "").strip()
+# When set (e.g. "/protected-uploads"), /uploads/* responses carry an
+# X-Accel-Redirect header and Nginx serves the bytes via sendfile from a
+# matching `internal` location instead of Python pushing them through Werkzeug.
+X_ACCEL_PREFIX: Final[str] = os.environ.get("X_ACCEL_UPLOADS_PREFIX", "").rstrip("/")
+
+# Parsed store keyed by the log/tombstone files' (st_mtime_ns, st_size) so
+# repeated GETs cost two stat() calls instead of a full read + parse.
+_CACHE: tuple[tuple[tuple[int, int], tuple[int, int]], list[dict[str, Any]]] | None = None
+_CACHE_LOCK = threading.Lock()
+
+# Cloudinary listing cache (fetch time, items, content ETag): concurrent
+# viewers share one upstream call per TTL window instead of each paying 1-2
+# HTTPS round trips.
+CLOUD_CACHE_TTL: Final[int] = 30  # seconds
+_CLOUD_CACHE: tuple[float, list[dict[str, Any]], str] | None = None
+_CLOUD_CACHE_LOCK = threading.Lock()
+
+# Uploads to Cloudinary run off the request thread; the browser gets its
+# redirect while the HTTPS POST is still in flight.
+_UPLOAD_POOL = ThreadPoolExecutor(max_workers=8, thread_name_prefix="cloud-upload") if USE_CLOUDINARY else None
+
+if USE_CLOUDINARY:
+    # The SDK's module-level connectors default to urllib3's maxsize=1 per
+    # host, so concurrent calls open and throw away TCP+TLS connections.
+    # Rebuild them once with a real pool and share across upload/admin APIs.
+    _cloud_http = cloudinary.utils.get_http_connector(
+        cloudinary.config(), dict(cloudinary.CERT_KWARGS, num_pools=16, maxsize=16)
+    )
+    cloudinary.uploader._http = _cloud_http
+    cloudinary.api_client.call_api._http = _cloud_http
 
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = MAX_CONTENT_LENGTH
 
+# Persist compiled templates across workers/restarts and skip the per-render
+# mtime check; templates only change with a deploy.
+_JINJA_CACHE_DIR = Path(tempfile.gettempdir()) / "limgp-jinja-cache"
+_JINJA_CACHE_DIR.mkdir(exist_ok=True)
+app.config["TEMPLATES_AUTO_RELOAD"] = False
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(str(_JINJA_CACHE_DIR))
+app.jinja_env.auto_reload = False
+
 if not USE_CLOUDINARY:
     UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
 
+@app.template_filter("datetimeformat")
+def _datetimeformat(value: Any) -> str:
+    """Render epoch-seconds timestamps; legacy ISO strings pass through as-is."""
+    if isinstance(value, (int, float)):
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(value))
+    return str(value)
+
+
 def _extract_year(created_at: str) -> str:
     try:
         return created_at[:4]
@@ -39,8 +116,135 @@ def _extract_year(created_at: str) -> str:
         return ""
 
 
+def _loads(raw: bytes) -> Any:
+    return orjson.loads(raw) if orjson is not None else json.loads(raw)
+
+
+def _dumps(obj: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+
+
+def _stat_sig(path: Path) -> tuple[int, int]:
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return (0, 0)
+    return (st.st_mtime_ns, st.st_size)
+
+
+def _store_sig() -> tuple[tuple[int, int], tuple[int, int]]:
+    return (_stat_sig(LOG_FILE), _stat_sig(TOMB_FILE))
+
+
+def _read_tombstones() -> set[str]:
+    try:
+        return {line for line in TOMB_FILE.read_text(encoding="utf-8").splitlines() if line}
+    except FileNotFoundError:
+        return set()
+
+
+def _migrate_legacy() -> None:
+    """One-time conversion of the old data.json list into the append log."""
+    if LOG_FILE.exists() or not DATA_FILE.exists():
+        return
+    try:
+        items = _loads(DATA_FILE.read_bytes())
+    except ValueError:
+        return
+    _write_log(items)
+    DATA_FILE.rename(DATA_FILE.with_name(DATA_FILE.name + ".bak"))
+
+
+def _write_log(items: Iterable[dict[str, Any]]) -> None:
+    """Atomically replace the log (oldest record first): readers see either the
+    old file or the new one."""
+    tmp = LOG_FILE.with_name(LOG_FILE.name + ".tmp")
+    with open(tmp, "wb", buffering=65536) as f:
+        for r in items:
+            f.write(_dumps(r) + b"\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, LOG_FILE)
+
+
+def _read_store() -> list[dict[str, Any]]:
+    _migrate_legacy()
+    if not LOG_FILE.exists():
+        return []
+    # Replay into a dict keyed by filename: a re-appended record overwrites its
+    # predecessor and each tombstone is a single O(1) pop.
+    index: dict[str, dict[str, Any]] = {}
+    for line in LOG_FILE.read_bytes().splitlines():
+        if not line:
+            continue
+        try:
+            record = _loads(line)
+        except ValueError:
+            continue
+        index[record.get("image") or record.get("id") or ""] = record
+    for tomb in _read_tombstones():
+        index.pop(tomb, None)
+    # Newest first, matching the Cloudinary listing order. The reversal happens
+    # once here, at cache-fill time, not on every GET.
+    return list(reversed(index.values()))
+
+
+def _append_item(record: dict[str, Any]) -> None:
+    global _CACHE
+    with open(LOG_FILE, "ab") as f:
+        f.write(_dumps(record) + b"\n")
+    # Splice the record into the cached list (a fresh list, so an in-flight
+    # render keeps its snapshot) instead of re-parsing the log on the next GET.
+    with _CACHE_LOCK:
+        if _CACHE is not None:
+            _CACHE = (_store_sig(), [record] + _CACHE[1])
+
+
+def _delete_item(filename: str) -> None:
+    global _CACHE
+    with open(TOMB_FILE, "a", encoding="utf-8") as f:
+        f.write(filename + "\n")
+    with _CACHE_LOCK:
+        if _CACHE is not None:
+            _CACHE = (_store_sig(), [i for i in _CACHE[1] if i.get("image") != filename])
+    if len(_read_tombstones()) >= COMPACT_AFTER:
+        _save_items(_load_items())
+
+
+_CLOUD_URL_BASE: str | None = None
+
+
+def _cloud_delivery_url(public_id: str) -> str:
+    """Delivery URL via a cached prefix; the options never vary between items."""
+    global _CLOUD_URL_BASE
+    if _CLOUD_URL_BASE is None:
+        probe = "__probe__"
+        url, _ = cloudinary.utils.cloudinary_url(
+            probe,
+            secure=True,
+            resource_type="image",
+            type="upload",
+            fetch_format="auto",
+        )
+        _CLOUD_URL_BASE = url[: -len(probe)]
+    return _CLOUD_URL_BASE + public_id
+
+
+def _invalidate_cloud_cache() -> None:
+    global _CLOUD_CACHE
+    with _CLOUD_CACHE_LOCK:
+        _CLOUD_CACHE = None
+
+
 def _load_items() -> list[dict[str, Any]]:
     if USE_CLOUDINARY:
+        global _CLOUD_CACHE
+        now = time.monotonic()
+        with _CLOUD_CACHE_LOCK:
+            if _CLOUD_CACHE is not None and now - _CLOUD_CACHE[0] < CLOUD_CACHE_TTL:
+                return _CLOUD_CACHE[1]
         try:
             resp = cloudinary.Search() \
                 .expression(f"tags:{TAG}") \
@@ -50,10 +254,9 @@ def _load_items() -> list[dict[str, Any]]:
                 .execute()
             resources = resp.get("resources", [])
         except Exception:
+            # An empty gallery is a valid Search answer; only an actual Search
+            # failure is worth a second round trip to the admin API.
             app.logger.exception("Cloudinary search failed")
-            resources = []
-
-        if not resources:
             try:
                 resp = cloudinary.api.resources(
                     resource_type="image",
@@ -79,13 +282,7 @@ def _load_items() -> list[dict[str, Any]]:
             public_id = r.get("public_id") or ""
             image_url = r.get("secure_url") or r.get("url")
             if public_id:
-                image_url, _ = cloudinary.utils.cloudinary_url(
-                    public_id,
-                    secure=True,
-                    resource_type="image",
-                    type="upload",
-                    fetch_format="auto",
-                )
+                image_url = _cloud_delivery_url(public_id)
             items.append(
                 {
                     "id": r.get("asset_id") or r.get("public_id"),
@@ -99,24 +296,53 @@ def _load_items() -> list[dict[str, Any]]:
                 }
             )
         items.sort(key=lambda x: x.get("created_at") or "", reverse=True)
+        # Hash the listing content so the validator is stable across refills
+        # and across gunicorn workers as long as the gallery is unchanged.
+        listing_key = "|".join(f"{i.get('public_id')},{i.get('created_at')}" for i in items)
+        etag = f'W/"cloud-{hashlib.sha1(listing_key.encode("utf-8")).hexdigest()[:20]}"'
+        with _CLOUD_CACHE_LOCK:
+            _CLOUD_CACHE = (now, items, etag)
         return items
-    if not DATA_FILE.exists():
-        return []
-    try:
-        return json.loads(DATA_FILE.read_text(encoding="utf-8"))
-    except json.JSONDecodeError:
-        return []
+    global _CACHE
+    sig = _store_sig()
+    with _CACHE_LOCK:
+        if _CACHE is not None and _CACHE[0] == sig:
+            return _CACHE[1]
+    items = _read_store()
+    with _CACHE_LOCK:
+        _CACHE = (sig, items)
+    return items
 
 
 def _save_items(items: list[dict[str, Any]]) -> None:
+    """Rewrite the whole log from a newest-first list; appends go via _append_item."""
+    global _CACHE
     if USE_CLOUDINARY:
         return
-    DATA_FILE.write_text(json.dumps(items, ensure_ascii=False, indent=2), encoding="utf-8")
+    _write_log(reversed(items))
+    if TOMB_FILE.exists():
+        TOMB_FILE.unlink()
+    with _CACHE_LOCK:
+        _CACHE = (_store_sig(), items)
+
+
+def _listing_etag() -> str:
+    """Weak validator that changes whenever the gallery contents can change."""
+    if USE_CLOUDINARY:
+        with _CLOUD_CACHE_LOCK:
+            if _CLOUD_CACHE is None:
+                return ""
+            return _CLOUD_CACHE[2]
+    sig = _store_sig()
+    return f'W/"{sig[0][0]}-{sig[0][1]}-{sig[1][0]}-{sig[1][1]}"'
 
 
 @app.route("/", methods=["GET"])
 def index():
     items = _load_items()
+    etag = _listing_etag()
+    if etag and request.headers.get("If-None-Match") == etag:
+        return "", 304
     year = request.args.get("year", "").strip()
     category = request.args.get("category", "").strip()
     if year:
@@ -129,73 +355,107 @@ def index():
     all_items = _load_items()
     years = sorted({str(i.get("year", "")) for i in all_items if i.get("year")}, reverse=True)
     categories = sorted({str(i.get("category", "")) for i in all_items if i.get("category")})
-    return render_template(
-        "index.html",
-        items=items,
-        msg=msg,
-        level=level,
-        debug=debug,
-        years=years,
-        selected_year=year,
-        categories=categories,
-        selected_category=category,
+    resp = make_response(
+        render_template(
+            "index.html",
+            items=items,
+            msg=msg,
+            level=level,
+            debug=debug,
+            years=years,
+            selected_year=year,
+            categories=categories,
+            selected_category=category,
+        )
     )
+    if etag:
+        resp.headers["ETag"] = etag
+        resp.headers["Cache-Control"] = "private, must-revalidate"
+    return resp
 
 
 @app.route("/uploads/<path:filename>")
 def uploaded_file(filename: str):
+    if X_ACCEL_PREFIX:
+        if filename != secure_filename(filename):
+            return Response(status=404)
+        mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+        return Response(
+            mimetype=mimetype,
+            headers={"X-Accel-Redirect": f"{X_ACCEL_PREFIX}/{filename}"},
+        )
     return send_from_directory(UPLOAD_DIR, filename)
 
 
+def _cloud_upload(path: str, caption: str, year: str, category: str) -> Any:
+    """Worker-side upload: streams the spooled file in chunks, then removes it."""
+    try:
+        return cloudinary.uploader.upload_large(
+            path,
+            chunk_size=UPLOAD_CHUNK_SIZE,
+            resource_type="image",
+            folder=CLOUD_FOLDER,
+            tags=[TAG],
+            context={"caption": caption, "year": year, "category": category},
+        )
+    finally:
+        os.unlink(path)
+
+
+def _upload_done(future: Future) -> None:
+    try:
+        future.result()
+    except Exception:
+        app.logger.exception("Cloudinary upload failed")
+    else:
+        _invalidate_cloud_cache()
+
+
 @app.route("/upload", methods=["POST"])
 def upload():
     caption = (request.form.get("caption") or "").strip()
     year = (request.form.get("year") or "").strip()
     if not year:
-        year = datetime.now().strftime("%Y")
+        year = time.strftime("%Y")
     category = (request.form.get("category") or "").strip()
     token = (request.form.get("token") or "").strip()
-    required = os.environ.get("UPLOAD_TOKEN", "").strip()
-    if required and token != required:
+    if REQUIRED_TOKEN and not hmac.compare_digest(token.encode("utf-8"), REQUIRED_TOKEN.encode("utf-8")):
         return redirect(url_for("index", msg="上传口令不正确", level="error"))
     file = request.files.get("image")
     if not file or file.filename == "":
         return redirect(url_for("index", msg="请选择图片文件", level="error"))
 
     filename = secure_filename(file.filename)
-    ext = Path(filename).suffix.lower()
+    dot = filename.rfind(".")
+    ext = filename[dot:].lower() if dot > 0 else ""
     if ext not in ALLOWED_EXTS:
         return redirect(url_for("index", msg="仅支持 JPG/PNG/GIF/WEBP 图片", level="error"))
 
     if USE_CLOUDINARY:
+        tmp = tempfile.NamedTemporaryFile(prefix="limgp-upload-", suffix=ext, delete=False)
         try:
-            cloudinary.uploader.upload(
-                file,
-                folder=CLOUD_FOLDER,
-                tags=[TAG],
-                context={"caption": caption, "year": year, "category": category},
-            )
-        except Exception:
-            app.logger.exception("Cloudinary upload failed")
-            return redirect(url_for("index", msg="上传失败，请稍后再试", level="error"))
+            file.save(tmp)
+        finally:
+            tmp.close()
+        future = _UPLOAD_POOL.submit(_cloud_upload, tmp.name, caption, year, category)
+        future.add_done_callback(_upload_done)
     else:
-        unique_name = f"{uuid.uuid4().hex}{ext}"
+        unique_name = f"{token_hex(16)}{ext}"
         save_path = UPLOAD_DIR / unique_name
         file.save(save_path)
 
-        items = _load_items()
-        items.append(
+        now = time.time()
+        _append_item(
             {
-                "id": uuid.uuid4().hex,
+                "id": token_hex(16),
                 "source": "local",
                 "image": unique_name,
                 "caption": caption,
-                "created_at": datetime.now().isoformat(timespec="seconds"),
-                "year": datetime.now().strftime("%Y"),
+                "created_at": int(now),
+                "year": time.strftime("%Y", time.localtime(now)),
                 "category": category,
             }
         )
-        _save_items(items)
 
     return redirect(url_for("index", msg="上传成功", level="success"))
 
@@ -208,8 +468,7 @@ def file_too_large(_):
 @app.route("/delete", methods=["POST"])
 def delete():
     token = (request.form.get("token") or "").strip()
-    required = os.environ.get("UPLOAD_TOKEN", "").strip()
-    if required and token != required:
+    if REQUIRED_TOKEN and not hmac.compare_digest(token.encode("utf-8"), REQUIRED_TOKEN.encode("utf-8")):
         return redirect(url_for("index", msg="管理口令不正确", level="error"))
 
     source = (request.form.get("source") or "").strip()
@@ -219,6 +478,7 @@ def delete():
             return redirect(url_for("index", msg="删除失败：缺少文件信息", level="error"))
         try:
             cloudinary.uploader.destroy(public_id, resource_type="image", type="upload")
+            _invalidate_cloud_cache()
         except Exception:
             app.logger.exception("Cloudinary delete failed")
             return redirect(url_for("index", msg="删除失败，请稍后再试", level="error"))
@@ -235,9 +495,7 @@ def delete():
         app.logger.exception("Local delete failed")
         return redirect(url_for("index", msg="删除失败，请稍后再试", level="error"))
 
-    items = _load_items()
-    items = [i for i in items if i.get("image") != filename]
-    _save_items(items)
+    _delete_item(filename)
     return redirect(url_for("index", msg="已删除", level="success"))
 
 